@@ -1,8 +1,17 @@
 # app_fuzzy_multi_mean.py
 import streamlit as st
 import pandas as pd
+import numpy as np
 from io import BytesIO
-from difflib import get_close_matches
+from types import MappingProxyType
+from rapidfuzz import process, fuzz
+
+# Prefer the Rust-based calamine reader; fall back to openpyxl if it isn't installed
+try:
+    import python_calamine  # noqa: F401
+    read_engine = "calamine"
+except ImportError:
+    read_engine = "openpyxl"
 
 st.set_page_config(page_title="Mean (SD) / Median(Range) Table Builder (Multi-sheet)", layout="wide")
 
@@ -20,8 +29,32 @@ if not uploaded_file:
     st.info("Please upload an Excel file that contains Mean,SD,Range, Median sheets.")
     st.stop()
 
-xls = pd.ExcelFile(uploaded_file)
-sheets = xls.sheet_names
+# Column mapping (read-only)
+expected_cols = MappingProxyType({
+    "FIRST_VISIT_TO_ACCEPT": "First visit to acceptance",
+    "ACCEPT_TO_FIRST_CONSULTANT_NOT": "Acceptance to first visit in OPD",
+    "CONSULTANT_NOTE_TO_MDT": "First Visit to MDT",
+    "DAYS_BTW_MDT_TO_1ST_THERAPY": "MDT to First Day of Therapy",
+    "FIRST_NOTE_TO_THERAPY": "First visit to First Day of Therapy"
+})
+
+# Keep only the category column and the expected columns of one sheet
+def parse_sheet(xls, name):
+    df = xls.parse(name)
+    if df.columns.empty:
+        return df
+    needed = [0] + [i for i, c in enumerate(df.columns) if i and str(c).strip().upper() in expected_cols]
+    return df.iloc[:, needed]
+
+# Parse the workbook once per file content; reruns reuse the cached sheets.
+# The cache is shared across sessions, so keep it small and let entries expire.
+@st.cache_data(max_entries=8, ttl=3600)
+def load_workbook_sheets(file_bytes):
+    with pd.ExcelFile(BytesIO(file_bytes), engine=read_engine) as xls:
+        return {name: parse_sheet(xls, name) for name in xls.sheet_names}
+
+sheets_dict = load_workbook_sheets(uploaded_file.getvalue())
+sheets = list(sheets_dict)
 st.write("Detected sheets:", sheets)
 
 # MULTI-select widgets
@@ -35,18 +68,23 @@ if not mean_sheets or not sd_sheets:
     st.stop()
 
 # Read multiple sheets and concatenate cell-wise
-def read_multi_sheets(file, sheet_list):
+def read_multi_sheets(sheets_dict, sheet_list):
     dfs = []
     for sheet in sheet_list:
-        df = pd.read_excel(file, sheet_name=sheet)
-        df = df.rename(columns={df.columns[0]:"Category"}).set_index("Category")
-        df.columns = [str(c).strip() for c in df.columns]
-        df = df.apply(pd.to_numeric, errors='coerce')
+        df = sheets_dict[sheet]
+        df = df.set_index(df.columns[0]).rename_axis("Category")
+        cols = df.columns
+        df = df.set_axis(range(len(cols)), axis=1)
+        # Already-numeric columns are left alone; the rest are coerced in one flat pass
+        obj = df.select_dtypes(exclude="number")
+        if len(obj.columns):
+            df[obj.columns] = pd.to_numeric(obj.to_numpy(dtype=object).ravel(), errors='coerce').reshape(obj.shape)
+        df.columns = [str(c).strip() for c in cols]
         dfs.append(df)
     return dfs
 
-mean_dfs = read_multi_sheets(uploaded_file, mean_sheets)
-sd_dfs = read_multi_sheets(uploaded_file, sd_sheets)
+mean_dfs = read_multi_sheets(sheets_dict, mean_sheets)
+sd_dfs = read_multi_sheets(sheets_dict, sd_sheets)
 
 # Category order
 category_order = [
@@ -76,7 +114,6 @@ final_columns = [
 def fix_non_specific(dfs):
     fixed_dfs = []
     for df in dfs:
-        df = df.copy()
         alt_names = ["Non-specific", "Non specific", "Non_specific"]
         for alt in alt_names:
             if alt in df.index:
@@ -90,76 +127,63 @@ def fix_non_specific(dfs):
 mean_dfs = fix_non_specific(mean_dfs)
 sd_dfs = fix_non_specific(sd_dfs)
 
-# Column mapping
-expected_cols = {
-    "FIRST_VISIT_TO_ACCEPT": "First visit to acceptance",
-    "ACCEPT_TO_FIRST_CONSULTANT_NOT": "Acceptance to first visit in OPD",
-    "CONSULTANT_NOTE_TO_MDT": "First Visit to MDT",
-    "DAYS_BTW_MDT_TO_1ST_THERAPY": "MDT to First Day of Therapy",
-    "FIRST_NOTE_TO_THERAPY": "First visit to First Day of Therapy"
-}
-
 def map_columns(df):
-    mapped = {}
-    for col in df.columns:
-        col_up = str(col).strip().upper()
-        if col_up in expected_cols:
-            mapped[col] = expected_cols[col_up]
-    return mapped
+    return {col: expected_cols[key] for col in df.columns if (key := str(col).strip().upper()) in expected_cols}
 
 mean_maps = [map_columns(df) for df in mean_dfs]
 sd_maps = [map_columns(df) for df in sd_dfs]
 
 # Fuzzy matching helper
 def fuzzy_match(cat, available_list):
-    match = get_close_matches(cat, available_list, n=1, cutoff=0.5)
+    match = process.extractOne(cat, available_list, scorer=fuzz.ratio, score_cutoff=50)
     if match:
         return match[0]
     else:
         return None
 
-# Combine multiple sheets cell-wise with dash
-def get_multi_values(dfs, maps, category, pretty_col):
-    values = []
+# Fuzzy-match every category against a sheet's index once; cached across reruns
+@st.cache_data(max_entries=64, ttl=3600)
+def match_categories(available):
+    return [fuzzy_match(cat, available) for cat in category_order]
+
+# Align one sheet to the final category/column grid (NaN where missing)
+def align_sheet(df, m):
+    df = df[list(m)].rename(columns=m)
+    df = df.loc[:, ~df.columns.duplicated(keep="last")]
+    # Blank category cells would otherwise match the None of unmatched categories
+    df = df[df.index.notna()]
+    # Repeated labels (e.g. two "Subtotal" rows) would make reindex fail; keep the first
+    df = df[~df.index.duplicated(keep="first")]
+    rows = match_categories(tuple(df.index.tolist()))
+    return df.reindex(index=rows, columns=final_columns).to_numpy(dtype=float)
+
+# Format each sheet's grid and combine them cell-wise with dash
+def combine_sheets(dfs, maps):
+    fmt = f"%.{decimals}f"
+    combined = None
     for df, m in zip(dfs, maps):
-        keys = [k for k,v in m.items() if v==pretty_col]
-        val = pd.NA
-        for k in keys:
-            matched_cat = fuzzy_match(category, df.index.tolist())
-            if matched_cat:
-                val = df.loc[matched_cat, k]
-        if pd.isna(val):
-            values.append("")
-        else:
-            values.append(val)
-    return "-".join(str(int(v)) if isinstance(v,(int,float)) and float(v).is_integer() else f"{v}" for v in values)
+        vals = align_sheet(df, m)
+        part = np.where(np.isnan(vals), "", np.char.mod(fmt, vals))
+        combined = part if combined is None else np.char.add(np.char.add(combined, "-"), part)
+    return combined
 
 # Prepare final DataFrame
-final_df = pd.DataFrame(index=category_order, columns=final_columns)
-
-for cat in category_order:
-    for pretty_col in final_columns:
-        mean_val = get_multi_values(mean_dfs, mean_maps, cat, pretty_col)
-        sd_val = get_multi_values(sd_dfs, sd_maps, cat, pretty_col)
-        
-        # Format decimals
-        if mean_val != "":
-            mean_vals = [float(v) if v!="" else pd.NA for v in mean_val.split("-")]
-            mean_vals_fmt = [f"{v:.{decimals}f}" if not pd.isna(v) else "" for v in mean_vals]
-            mean_val = "-".join(mean_vals_fmt)
-        if sd_val != "":
-            sd_vals = [float(v) if v!="" else pd.NA for v in sd_val.split("-")]
-            sd_vals_fmt = [f"{v:.{decimals}f}" if not pd.isna(v) else "" for v in sd_vals]
-            sd_val = "-".join(sd_vals_fmt)
-        
-        if mean_val=="" and sd_val=="":
-            final_df.loc[cat, pretty_col] = "–"
-        elif mean_val!="" and sd_val=="":
-            final_df.loc[cat, pretty_col] = mean_val
-        elif mean_val=="" and sd_val!="":
-            final_df.loc[cat, pretty_col] = f"({sd_val})"
-        else:
-            final_df.loc[cat, pretty_col] = f"{mean_val} ({sd_val})"
+mean_str = combine_sheets(mean_dfs, mean_maps)
+sd_str = combine_sheets(sd_dfs, sd_maps)
+mean_empty = mean_str == ""
+sd_empty = sd_str == ""
+
+cells = np.where(
+    mean_empty & sd_empty, "–",
+    np.where(
+        sd_empty, mean_str,
+        np.where(
+            mean_empty, np.char.add(np.char.add("(", sd_str), ")"),
+            np.char.add(np.char.add(np.char.add(mean_str, " ("), sd_str), ")")
+        )
+    )
+)
+final_df = pd.DataFrame(cells, index=category_order, columns=final_columns, dtype="string[pyarrow]")
 
 st.markdown(f"### Final Table (Mean (SD)) — {decimals} Decimal Place(s)")
 st.dataframe(final_df.reset_index().rename(columns={"index":"Category"}), use_container_width=True)
@@ -167,7 +191,7 @@ st.dataframe(final_df.reset_index().rename(columns={"index":"Category"}), use_co
 # Excel download
 def to_excel_bytes(df):
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
         df.to_excel(writer, sheet_name="Mean_SD_Table")
     return output.getvalue()
 